@@ -0,0 +1,311 @@
+# benchmark.py
+"""Офлайн-бенчмарк обработчиков бота на синтетической нагрузке.
+
+Обновления проходят через настоящий Application, а Bot API заменен
+заглушкой из stub_api.py, так что сеть не нужна. Пример:
+
+    python benchmark.py --chats 50 --members 300 --messages 20000 --save-baseline bench.json
+    python benchmark.py --chats 50 --members 300 --messages 20000 --compare bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарк обработчиков бота без Telegram")
+    parser.add_argument('--chats', type=int, default=20, help="число чатов")
+    parser.add_argument('--members', type=int, default=200, help="участников в чате")
+    parser.add_argument('--messages', type=int, default=10000, help="всего обновлений")
+    parser.add_argument('--rate', type=float, default=0,
+                        help="обновлений в секунду (0 - без пауз)")
+    parser.add_argument('--all-ratio', type=float, default=0.01, help="доля сообщений с @all")
+    parser.add_argument('--join-ratio', type=float, default=0.01,
+                        help="доля событий о новых участниках")
+    parser.add_argument('--members-ratio', type=float, default=0.005, help="доля /members")
+    parser.add_argument('--cleanup-ratio', type=float, default=0.0005, help="доля /cleanup")
+    parser.add_argument('--backend', default='json', choices=('json', 'sqlite', 'segments'))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--save-baseline', metavar='PATH', help="сохранить результат как базовый")
+    parser.add_argument('--compare', metavar='PATH', help="сравнить с базовым результатом")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="допустимое ухудшение при сравнении (0.2 = 20%%)")
+    return parser.parse_args(argv)
+
+
+def user_dict(user_id, is_bot=False):
+    user = {'id': user_id, 'is_bot': is_bot, 'first_name': f'Имя {user_id}'}
+    # Примерно у каждого пятого нет username
+    if user_id % 5:
+        user['username'] = f'user{user_id}'
+    return user
+
+
+def message_dict(update_id, chat_id, user_id, text=None, **extra):
+    message = {
+        'message_id': update_id,
+        'date': 0,
+        'chat': {'id': chat_id, 'type': 'supergroup', 'title': f'Chat {chat_id}'},
+        'from': user_dict(user_id)
+    }
+    if text is not None:
+        message['text'] = text
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+    message.update(extra)
+    return {'update_id': update_id, 'message': message}
+
+
+def generate_workload(args):
+    """Список (тип, данные обновления) по параметрам нагрузки"""
+    rng = random.Random(args.seed)
+    chats = [-1000000000000 - index for index in range(args.chats)]
+    next_user_id = 10 ** 6 + args.chats * args.members
+    workload = []
+
+    for update_id in range(1, args.messages + 1):
+        chat_index = rng.randrange(args.chats)
+        chat_id = chats[chat_index]
+        user_id = 10 ** 6 + chat_index * args.members + rng.randrange(args.members)
+        roll = rng.random()
+
+        if roll < args.join_ratio:
+            joined = [user_dict(next_user_id + offset) for offset in range(rng.randint(1, 3))]
+            next_user_id += len(joined)
+            workload.append(('join', message_dict(update_id, chat_id, user_id,
+                                                  new_chat_members=joined)))
+            continue
+        roll -= args.join_ratio
+        if roll < args.members_ratio:
+            workload.append(('members', message_dict(update_id, chat_id, user_id, '/members')))
+            continue
+        roll -= args.members_ratio
+        if roll < args.cleanup_ratio:
+            workload.append(('cleanup', message_dict(update_id, chat_id, user_id, '/cleanup')))
+            continue
+        roll -= args.cleanup_ratio
+        text = 'Всем привет @all' if roll < args.all_ratio else f'сообщение {update_id}'
+        workload.append(('message', message_dict(update_id, chat_id, user_id, text)))
+
+    return chats, workload
+
+
+def seed_members(chats, args):
+    """members.json, в котором каждый чат уже знает всех своих участников"""
+    members = {}
+    for chat_index, chat_id in enumerate(chats):
+        first_user = 10 ** 6 + chat_index * args.members
+        members[str(chat_id)] = {}
+        for user_id in range(first_user, first_user + args.members):
+            user = user_dict(user_id)
+            members[str(chat_id)][str(user_id)] = {
+                'username': user.get('username'),
+                'first_name': user['first_name']
+            }
+    return members
+
+
+def read_io_bytes():
+    """Сколько байт процесс записал через write() (Linux, /proc/self/io)"""
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                if line.startswith('wchar:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def timed(callback, name, latencies):
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            latencies[name].append(time.perf_counter() - started)
+    return wrapper
+
+
+def timed_sends(dispatcher, latencies):
+    """Замеряет фоновые отправки диспетчера: <вид>_send от запуска до последнего сообщения"""
+    start_send = dispatcher.start_send
+
+    async def measure(coroutine, name):
+        started = time.perf_counter()
+        try:
+            return await coroutine
+        finally:
+            latencies[name].append(time.perf_counter() - started)
+
+    def wrapper(bot, chat_id, chunks, reply_to=None, create_task=asyncio.create_task, kind='mentions'):
+        return start_send(bot, chat_id, chunks, reply_to,
+                          lambda coroutine: create_task(measure(coroutine, f'{kind}_send')), kind)
+
+    dispatcher.start_send = wrapper
+
+
+async def run_benchmark(args):
+    os.environ['MEMBERS_BACKEND'] = args.backend
+    sys.path.insert(0, REPO_DIR)
+    import main
+    from mentions import RateLimiter
+    from storage import convert_members
+    from stub_api import StubRequest
+    from telegram import Update
+
+    chats, workload = generate_workload(args)
+    with open(main.MEMBERS_FILE, 'w', encoding='utf-8') as f:
+        json.dump(seed_members(chats, args), f, ensure_ascii=False)
+    if args.backend != 'json':
+        convert_members(main.MEMBERS_FILE, args.backend, main.STORAGE_PATHS[args.backend])
+
+    main.registry.load()
+    # Измеряем работу бота, а не ожидание лимитов Telegram
+    main.dispatcher.limiter = RateLimiter(1e9, 10 ** 9, 1e9, 10 ** 9)
+
+    stub = StubRequest()
+    application = main.build_application('0:benchmark', request=stub, get_updates_request=stub)
+    latencies = defaultdict(list)
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = timed(handler.callback, handler.callback.__name__, latencies)
+    timed_sends(main.dispatcher, latencies)
+
+    async with application:
+        await application.start()
+        flusher = asyncio.create_task(main.registry.run_flusher())
+        updates = [(kind, Update.de_json(data, application.bot)) for kind, data in workload]
+        interval = 1 / args.rate if args.rate else 0
+        io_before = read_io_bytes()
+        started = time.perf_counter()
+
+        for index, (kind, update) in enumerate(updates):
+            if interval:
+                delay = started + index * interval - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            await application.process_update(update)
+            # @all и /members отправляются в фоне: ждем их, иначе следующие
+            # @all в том же чате объединились бы с незавершенной рассылкой
+            await main.dispatcher.wait()
+
+        await application.stop()
+        flusher.cancel()
+        await main.registry.flush_async()
+        elapsed = time.perf_counter() - started
+        io_after = read_io_bytes()
+
+    handlers = {
+        name: {
+            'count': len(values),
+            'p50_ms': percentile(values, 0.50) * 1000,
+            'p99_ms': percentile(values, 0.99) * 1000
+        }
+        for name, values in sorted(latencies.items())
+    }
+    return {
+        'params': {key: value for key, value in vars(args).items()
+                   if key not in ('save_baseline', 'compare', 'tolerance')},
+        'handlers': handlers,
+        'updates_per_second': len(updates) / elapsed if elapsed else 0.0,
+        'api_calls': len(stub.calls),
+        'bytes_written': (io_after - io_before) if io_before is not None else None,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    }
+
+
+def print_report(result):
+    print(f"{'обработчик':<20}{'вызовов':>10}{'p50, мс':>12}{'p99, мс':>12}")
+    for name, stats in result['handlers'].items():
+        print(f"{name:<20}{stats['count']:>10}{stats['p50_ms']:>12.3f}{stats['p99_ms']:>12.3f}")
+    print(f"\nОбновлений в секунду: {result['updates_per_second']:.1f}")
+    print(f"Вызовов Bot API: {result['api_calls']}")
+    if result['bytes_written'] is not None:
+        print(f"Записано байт: {result['bytes_written']}")
+    print(f"Пиковый RSS: {result['peak_rss_kb']} КБ")
+
+
+def compare(result, baseline, tolerance):
+    """Печатает разницу с базовым результатом. Возвращает список регрессий"""
+    regressions = []
+
+    def check(name, current, previous, lower_is_better=True):
+        if current is None or not previous:
+            return
+        change = (current - previous) / previous
+        worse = change > tolerance if lower_is_better else change < -tolerance
+        mark = "❌" if worse else "  "
+        print(f"{mark} {name:<40}{previous:>14.3f} -> {current:<14.3f}{change:+.1%}")
+        if worse:
+            regressions.append(name)
+
+    if baseline.get('params') != result['params']:
+        print("⚠️ Параметры нагрузки отличаются от базовых, сравнение может быть неточным")
+
+    for name, stats in result['handlers'].items():
+        for metric in ('p50_ms', 'p99_ms'):
+            previous = baseline.get('handlers', {}).get(name, {}).get(metric)
+            check(f"{name}.{metric}", stats[metric], previous)
+    check('updates_per_second', result['updates_per_second'],
+          baseline.get('updates_per_second'), lower_is_better=False)
+    for metric in ('bytes_written', 'peak_rss_kb'):
+        check(metric, result[metric], baseline.get(metric))
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    workdir = tempfile.mkdtemp(prefix='alias-bench-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        result = asyncio.run(run_benchmark(args))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(result)
+
+    if save_path:
+        with open(save_path, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 Базовый результат сохранен в {save_path}")
+
+    if compare_path:
+        with open(compare_path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f"\nСравнение с {compare_path}:")
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions:
+            print(f"\n❌ Регрессии: {', '.join(regressions)}")
+            return 1
+        print("\n✅ Регрессий нет")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
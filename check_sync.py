@@ -0,0 +1,123 @@
+# check_sync.py
+"""Проверка SyncService на локальном git-репозитории без GitHub.
+
+Создает во временном каталоге голый репозиторий (git init --bare) и два
+клона: бот синхронизирует первый, второй играет роль другой копии бота.
+
+    python check_sync.py
+"""
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from sync_data import SyncService
+
+
+DATA_FILE = 'members.json'
+
+
+def git(cwd, *args):
+    return subprocess.run(['git', *args], cwd=cwd, check=True, capture_output=True, text=True).stdout
+
+
+def clone(remote, path, name):
+    git(os.path.dirname(path), 'clone', '-q', remote, path)
+    git(path, 'config', 'user.email', f'{name}@example.com')
+    git(path, 'config', 'user.name', name)
+
+
+def write_members(path, members):
+    with open(os.path.join(path, DATA_FILE), 'w', encoding='utf-8') as f:
+        json.dump(members, f, ensure_ascii=False, indent=2)
+
+
+def read_members(path):
+    with open(os.path.join(path, DATA_FILE), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+async def run_checks(workdir):
+    failures = []
+
+    def check(name, condition):
+        print(f"{'✅' if condition else '❌'} {name}")
+        if not condition:
+            failures.append(name)
+
+    remote = os.path.join(workdir, 'remote.git')
+    bot_dir = os.path.join(workdir, 'bot')
+    other_dir = os.path.join(workdir, 'other')
+    git(workdir, 'init', '-q', '--bare', remote)
+    clone(remote, bot_dir, 'bot')
+    write_members(bot_dir, {'-1': {'1': {'username': 'one', 'first_name': 'One'}}})
+    git(bot_dir, 'add', DATA_FILE)
+    git(bot_dir, 'commit', '-q', '-m', 'init')
+    git(bot_dir, 'push', '-q', 'origin', 'HEAD')
+    clone(remote, other_dir, 'other')
+
+    service = SyncService(cwd=bot_dir, data_file=DATA_FILE, debounce=0.1)
+
+    check("push без изменений ничего не делает", await service.push_changes() is False)
+
+    write_members(bot_dir, {'-1': {'1': {'username': 'one', 'first_name': 'One'},
+                                   '2': {'username': 'two', 'first_name': 'Two'}}})
+    check("push отправляет измененный файл", await service.push_changes() is True)
+    git(other_dir, 'pull', '-q')
+    check("изменения видны в другом клоне", '2' in read_members(other_dir)['-1'])
+
+    members = read_members(other_dir)
+    members['-5'] = {'9': {'username': None, 'first_name': 'Nine'}}
+    write_members(other_dir, members)
+    git(other_dir, 'commit', '-q', '-am', 'other')
+    git(other_dir, 'push', '-q')
+
+    # Незакоммиченная локальная копия не должна мешать pull
+    write_members(bot_dir, {'-1': {}})
+    check("pull сообщает о новых коммитах", await service.pull() is True)
+    check("после pull файл совпадает с удаленным", read_members(bot_dir) == members)
+    check("повторный pull без новых коммитов", await service.pull() is False)
+
+    write_members(bot_dir, {**members, '-7': {}})
+    pushed, pulled = await service.sync()
+    check("sync отправляет изменения", pushed and not pulled)
+    check("статус после sync", service.status()['state'] == 'idle' and service.last_error is None)
+
+    service.notify_changed()
+    write_members(bot_dir, {**members, '-8': {}})
+    background = asyncio.create_task(service.run())
+    for _ in range(50):
+        await asyncio.sleep(0.1)
+        if not git(bot_dir, 'status', '--porcelain', '--', DATA_FILE).strip():
+            break
+    background.cancel()
+    git(other_dir, 'pull', '-q')
+    check("фоновая задача отправляет изменения после notify_changed", '-8' in read_members(other_dir))
+
+    git(bot_dir, 'remote', 'set-url', 'origin', os.path.join(workdir, 'missing.git'))
+    try:
+        await service.pull()
+    except subprocess.CalledProcessError:
+        pass
+    check("ошибка git сохраняется в last_error", bool(service.last_error))
+    return failures
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='alias-sync-')
+    try:
+        failures = asyncio.run(run_checks(workdir))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failures:
+        print(f"\n❌ Не прошли проверки: {len(failures)}")
+        return 1
+    print("\n✅ Все проверки прошли")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
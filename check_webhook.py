@@ -0,0 +1,124 @@
+# check_webhook.py
+"""Проверка режима webhook без Telegram.
+
+Поднимает настоящий веб-сервер бота на локальном порту, а Bot API заменяет
+заглушкой из stub_api.py. Затем отправляет POST-запросы так, как это делает
+Telegram, с секретом и без него.
+
+    python check_webhook.py --port 18443
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import sys
+import tempfile
+
+import httpx
+
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+SECRET = 'check-secret'
+CHAT_ID = -1001
+
+
+def message_update(update_id, user_id, text):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': CHAT_ID, 'type': 'supergroup', 'title': 'Check'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': f'User {user_id}',
+                     'username': f'user{user_id}'},
+            'text': text
+        }
+    }
+
+
+async def wait_for(condition, timeout=5.0):
+    for _ in range(int(timeout / 0.05)):
+        if condition():
+            return True
+        await asyncio.sleep(0.05)
+    return condition()
+
+
+async def run_checks(port):
+    sys.path.insert(0, REPO_DIR)
+    import main
+    from stub_api import StubRequest
+
+    failures = []
+
+    def check(name, condition):
+        print(f"{'✅' if condition else '❌'} {name}")
+        if not condition:
+            failures.append(name)
+
+    def sent_texts():
+        return [params.get('text', '') for method, params in stub.calls if method == 'sendMessage']
+
+    main.registry.load()
+    stub = StubRequest()
+    application = main.build_application('0:check', request=stub, get_updates_request=stub)
+    url = f'http://127.0.0.1:{port}/{main.WEBHOOK_PATH}'
+
+    async with application:
+        await application.start()
+        await application.updater.start_webhook(
+            listen='127.0.0.1', port=port, url_path=main.WEBHOOK_PATH,
+            webhook_url=f'https://example.invalid/{main.WEBHOOK_PATH}',
+            secret_token=SECRET
+        )
+        try:
+            async with httpx.AsyncClient() as client:
+                response = await client.post(url, json=message_update(1, 11, 'привет'))
+                check("запрос без секрета отклонен (403)", response.status_code == 403)
+                response = await client.post(url, json=message_update(2, 11, 'привет'),
+                                             headers={'X-Telegram-Bot-Api-Secret-Token': 'wrong'})
+                check("запрос с неверным секретом отклонен (403)", response.status_code == 403)
+
+                headers = {'X-Telegram-Bot-Api-Secret-Token': SECRET}
+                statuses = set()
+                for update_id, user_id in ((3, 11), (4, 12), (5, 13)):
+                    response = await client.post(url, json=message_update(update_id, user_id, 'привет'),
+                                                 headers=headers)
+                    statuses.add(response.status_code)
+                check("запросы с секретом приняты (200)", statuses == {200})
+                check("участники запомнены",
+                      await wait_for(lambda: len(main.registry.get_chat(CHAT_ID)) == 3))
+
+                response = await client.post(url, json=message_update(6, 11, 'Всем @all'), headers=headers)
+                check("@all принят (200)", response.status_code == 200)
+                check("отправлено упоминание всех участников",
+                      await wait_for(lambda: any('@user13' in text for text in sent_texts())))
+                check("отклоненные обновления не обработаны", main.registry.get_chat(CHAT_ID).keys() == {11, 12, 13})
+        finally:
+            await application.updater.stop()
+            await application.stop()
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Проверка режима webhook на заглушке Bot API")
+    parser.add_argument('--port', type=int, default=18443)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='alias-webhook-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        failures = asyncio.run(run_checks(args.port))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+    if failures:
+        print(f"\n❌ Не прошли проверки: {len(failures)}")
+        return 1
+    print("\n✅ Все проверки прошли")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
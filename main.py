@@ -1,122 +1,132 @@
-from telegram import Update
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
-import json
+from telegram import ChatMember, Update
+from telegram.ext import Application, ChatMemberHandler, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
+import asyncio
 import os
-import html
 import atexit
-import subprocess
 import signal
 import sys
 from dotenv import load_dotenv
+import metrics
+from mentions import (
+    MENTION_HEADER, MEMBERS_HEADER, MentionAllFilter, MentionDispatcher, chunk_parts,
+    render_member_lines, render_mentions
+)
+from storage import MemberRegistry, RecentlySeen, create_backend
+from sync_data import SyncService
 
 
 load_dotenv()
 
-MEMBERS_FILE = 'members.json'
+MEMBERS_FILE = os.getenv('MEMBERS_FILE', 'members.json')
+MEMBERS_DB = os.getenv('MEMBERS_DB', 'members.db')
+MEMBERS_DIR = os.getenv('MEMBERS_DIR', 'members.d')
+# json - совместимый members.json, sqlite - индексированная база,
+# segments - каталог с файлом на каждый чат (см. migrate_members.py)
+STORAGE_BACKEND = os.getenv('MEMBERS_BACKEND', 'json')
+STORAGE_PATHS = {'json': MEMBERS_FILE, 'sqlite': MEMBERS_DB, 'segments': MEMBERS_DIR}
+FLUSH_INTERVAL = float(os.getenv('MEMBERS_FLUSH_INTERVAL', '5'))
+FLUSH_THRESHOLD = int(os.getenv('MEMBERS_FLUSH_THRESHOLD', '100'))
+SYNC_DEBOUNCE = float(os.getenv('SYNC_DEBOUNCE', '60'))
+# В git хранится только members.json, поэтому синхронизация работает лишь с хранилищем json.
+# GIT_SYNC=0 выключает ее совсем (так делают воркеры supervisor.py)
+SYNC_ENABLED = STORAGE_BACKEND == 'json' and os.getenv('GIT_SYNC', '1') != '0'
+MENTION_CACHE_BYTES = int(os.getenv('MENTION_CACHE_BYTES', str(8 * 1024 * 1024)))
+# Когда выгружать из памяти неактивные чаты (только sqlite и segments)
+CHAT_IDLE_TTL = float(os.getenv('CHAT_IDLE_TTL', '3600'))
+MAX_LOADED_CHATS = int(os.getenv('MAX_LOADED_CHATS', '10000'))
 
-def setup_sync():
-    """Настраивает синхронизацию при запуске и завершении"""
-    # Синхронизируем при запуске
-    sync_with_github()
-    
-    # Регистрируем функцию для синхронизации при завершении
-    atexit.register(sync_on_exit)
+# polling (по умолчанию) или webhook
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Публичный адрес, который видит Telegram (обычно адрес reverse proxy)
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '127.0.0.1')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'telegram')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+# Максимум необработанных обновлений: при переполнении веб-сервер ждет, а не копит память
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1000'))
+# Сколько обновлений обрабатывается одновременно (1 - по очереди)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '1'))
+# Алиасы для упоминания всех через запятую, например "@all,@everyone"
+MENTION_ALIASES = [alias.strip() for alias in os.getenv('MENTION_ALIASES', '@all').split(',') if alias.strip()]
+# Сколько секунд не обновлять участника, который уже писал в чат
+SEEN_TTL = float(os.getenv('SEEN_TTL', '300'))
+# Порт локальной страницы /metrics для Prometheus (не задан - сервер не запускается)
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = os.getenv('METRICS_PORT')
+
+registry = MemberRegistry(
+    create_backend(STORAGE_BACKEND, STORAGE_PATHS[STORAGE_BACKEND]),
+    FLUSH_INTERVAL,
+    FLUSH_THRESHOLD,
+    MENTION_CACHE_BYTES,
+    CHAT_IDLE_TTL,
+    MAX_LOADED_CHATS
+)
+dispatcher = MentionDispatcher()
+recently_seen = RecentlySeen(SEEN_TTL)
+mention_all_filter = MentionAllFilter(MENTION_ALIASES)
+sync_service = SyncService(data_file=MEMBERS_FILE, debounce=SYNC_DEBOUNCE)
+if SYNC_ENABLED:
+    registry.on_flush = sync_service.notify_changed
 
-def sync_with_github():
+async def pull_updates():
+    """Забирает обновления с GitHub и добавляет пришедших участников в реестр"""
     try:
         print("🔁 Проверяем обновления с GitHub...")
-        result = subprocess.run(["git", "pull"], 
-                              capture_output=True, text=True, cwd=os.getcwd())
-        if result.returncode == 0:
-            print("✅ Данные обновлены с GitHub")
+        # Пока идет pull, реестр не пишет файл; затем файл пишется заново из памяти
+        async with registry.writes_paused():
+            pulled = await sync_service.pull()
+            added = registry.merge(load_members()) if pulled else 0
+        await registry.flush_async()
+        if pulled:
+            print(f"✅ Данные обновлены с GitHub, новых участников: {added}")
         else:
-            print("❌ Ошибка при получении данных:", result.stderr)
+            print("ℹ️ Новых данных на GitHub нет")
     except Exception as e:
-        print(f"❌ Ошибка синхронизации: {e}")
+        print(f"❌ Ошибка при получении данных: {sync_service.last_error or e}")
 
-def sync_on_exit():
-    """Синхронизирует данные при завершении работы"""
+async def push_on_exit():
+    """Отправляет несохраненные изменения при завершении работы"""
     try:
         print("🔁 Отправляем данные на GitHub...")
-        
-        # Проверяем есть ли изменения
-        result = subprocess.run(["git", "status", "--porcelain"], 
-                              capture_output=True, text=True, cwd=os.getcwd())
-        
-        if "members.json" in result.stdout:
-            from datetime import datetime
-            
-            # Добавляем файл
-            subprocess.run(["git", "add", "members.json"], check=True, cwd=os.getcwd())
-            
-            # Коммитим
-            commit_message = f"Auto-sync: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-            subprocess.run(["git", "commit", "-m", commit_message], 
-                         check=True, cwd=os.getcwd())
-            
-            # Пушим
-            subprocess.run(["git", "push"], check=True, cwd=os.getcwd())
+        if await sync_service.push_changes():
             print("✅ Данные отправлены на GitHub")
         else:
             print("ℹ️ Изменений нет, синхронизация не требуется")
-            
     except Exception as e:
-        print(f"❌ Ошибка при отправке данных: {e}")
+        print(f"❌ Ошибка при отправке данных: {sync_service.last_error or e}")
 
 
 def load_members():
-    """Загружаем данные из файла"""
-    if os.path.exists(MEMBERS_FILE):
-        try:
-            with open(MEMBERS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            print("❌ Ошибка чтения members.json, создаем новый файл")
-            return {}
-    return {}
+    """Загружаем данные из хранилища"""
+    with metrics.STORAGE_LOAD.time():
+        return registry.backend.load_all()
 
 def save_member(chat_id, user_id, username, first_name, is_bot=False):
+    """Ставит участника в очередь: изменения чата применяются одной пачкой"""
     if is_bot:
         return
     
-    members = load_members()
-    
-    chat_key = str(chat_id)
-    user_key = str(user_id)
-    
-    if chat_key not in members:
-        members[chat_key] = {}
-    
-    members[chat_key][user_key] = {
-        'username': username,
-        'first_name': first_name or 'Участник'
-    }
-    
-    with open(MEMBERS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(members, f, ensure_ascii=False, indent=2)
+    registry.queue_upsert(chat_id, user_id, username, first_name)
+
+def forget_member(chat_id, user_id):
+    registry.queue_remove(chat_id, user_id)
+    recently_seen.forget(chat_id, user_id)
 
 def get_all_members(chat_id):
-    members = load_members()
-    chat_key = str(chat_id)
-    return members.get(chat_key, {})
+    return registry.get_chat(chat_id)
 
-def create_safe_mention_text(members):
+def create_mention_chunks(members):
+    """Упоминания всех участников, разбитые на сообщения допустимой длины"""
     if not members:
-        return "❌ Нет участников для упоминания"
+        return ["❌ Нет участников для упоминания"]
     
-    mentions = []
-    for user_id, user_data in members.items():
-        username = user_data.get('username')
-        first_name = user_data.get('first_name', 'Участник')
-        
-        safe_first_name = html.escape(first_name)
-        
-        if username:
-            mentions.append(f"@{username}")
-        else:
-            mentions.append(f"👤 {safe_first_name} (ID: {user_id})")
-    
-    return " ".join(mentions)
+    return chunk_parts(render_mentions(members), header=MENTION_HEADER)
+
+def create_member_list_chunks(members):
+    return chunk_parts(render_member_lines(members), header=MEMBERS_HEADER, separator="\n")
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -135,50 +145,57 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Команды:\n"
         "/start - начать работу\n"
         "/help - эта справка\n"
-        "/members - показать список участников"
+        "/members - показать список участников\n"
+        "/import - добавить администраторов чата"
     )
 
+def in_background(context, update):
+    """create_task для отправки в фоне: ошибки попадут в error_handler"""
+    return lambda coroutine: context.application.create_task(coroutine, update=update)
+
 async def members_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     members = get_all_members(chat_id)
     
     if members:
-        member_list = "📋 Список участников:\n\n"
-        for user_id, user_data in members.items():
-            username = user_data.get('username')
-            first_name = user_data.get('first_name', 'Участник')
-            
-            if username:
-                member_list += f"• @{username} ({first_name})\n"
-            else:
-                member_list += f"• {first_name} (ID: {user_id})\n"
-        
-        await update.message.reply_text(member_list)
+        dispatcher.start_send(
+            context.bot, chat_id, registry.rendered(chat_id, 'members', create_member_list_chunks),
+            reply_to=update.message.message_id, create_task=in_background(context, update),
+            kind='members'
+        )
     else:
         await update.message.reply_text("❌ Нет сохраненных участников. Начните общение в чате!")
 
+def remember_sender(message):
+    """Сохраняет автора сообщения, если его не видели последние SEEN_TTL секунд"""
+    user = message.from_user
+    if recently_seen.check(message.chat_id, user.id):
+        return
+    save_member(message.chat_id, user.id, user.username, user.first_name, user.is_bot)
+
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not update.message or not update.message.text:
         return
     
+    remember_sender(update.message)
+
+async def handle_mention_all(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
-    user = update.message.from_user
+    remember_sender(update.message)
     
-    save_member(chat_id, user.id, user.username, user.first_name, user.is_bot)
+    members = get_all_members(chat_id)
     
-    if '@all' in update.message.text.lower():
-        members = get_all_members(chat_id)
-        
-        if members:
-            mention_text = create_safe_mention_text(members)
-            
-            await update.message.reply_text(
-                f"📢 Упоминание всех участников!\n\n{mention_text}"
-            )
-        else:
-            await update.message.reply_text(
-                "❌ Нет сохраненных участников. Подождите, пока участники напишут сообщения."
-            )
+    if members:
+        if dispatcher.in_progress(chat_id):
+            return
+        dispatcher.start_fan_out(
+            context.bot, chat_id, registry.rendered(chat_id, 'mentions', create_mention_chunks),
+            reply_to=update.message.message_id, create_task=in_background(context, update)
+        )
+    else:
+        await update.message.reply_text(
+            "❌ Нет сохраненных участников. Подождите, пока участники напишут сообщения."
+        )
 
 async def track_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.message.new_chat_members:
@@ -203,6 +220,44 @@ async def track_new_members(update: Update, context: ContextTypes.DEFAULT_TYPE):
             
             await update.message.reply_text(welcome_text)
 
+async def track_left_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    forget_member(update.message.chat_id, update.message.left_chat_member.id)
+
+async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обновления chat_member приходят, только если бот - администратор чата"""
+    change = update.chat_member
+    member = change.new_chat_member
+    user = member.user
+    
+    if member.status in [ChatMember.LEFT, ChatMember.BANNED]:
+        forget_member(change.chat.id, user.id)
+    elif member.status != ChatMember.RESTRICTED or member.is_member:
+        save_member(change.chat.id, user.id, user.username, user.first_name, user.is_bot)
+
+async def import_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_id = update.message.chat_id
+    
+    try:
+        chat_member, administrators = await asyncio.gather(
+            context.bot.get_chat_member(chat_id, update.message.from_user.id),
+            context.bot.get_chat_administrators(chat_id)
+        )
+        
+        if chat_member.status in ['administrator', 'creator']:
+            human_users = [admin.user for admin in administrators if not admin.user.is_bot]
+            for user in human_users:
+                save_member(chat_id, user.id, user.username, user.first_name, user.is_bot)
+            
+            await update.message.reply_text(
+                f"✅ Добавлено администраторов: {len(human_users)}.\n"
+                f"Остальные участники добавятся, когда напишут сообщение."
+            )
+        else:
+            await update.message.reply_text("❌ Эта команда только для администраторов.")
+            
+    except Exception as e:
+        await update.message.reply_text(f"❌ Ошибка при выполнении команды: {e}")
+
 async def cleanup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.message.chat_id
     
@@ -210,17 +265,10 @@ async def cleanup_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_member = await context.bot.get_chat_member(chat_id, update.message.from_user.id)
         
         if chat_member.status in ['administrator', 'creator']:
-            members = load_members()
-            chat_key = str(chat_id)
+            count_before = registry.clear_chat(chat_id)
+            recently_seen.forget_chat(chat_id)
             
-            if chat_key in members:
-                count_before = len(members[chat_key])
-                
-                members[chat_key] = {}
-                
-                with open(MEMBERS_FILE, 'w', encoding='utf-8') as f:
-                    json.dump(members, f, ensure_ascii=False, indent=2)
-                
+            if count_before is not None:
                 await update.message.reply_text(
                     f"✅ Список участников очищен! Удалено {count_before} участников.\n"
                     f"Участники будут добавляться заново при написании сообщений."
@@ -243,36 +291,167 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             pass
 
 async def sync_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not SYNC_ENABLED:
+        await update.message.reply_text(
+            "ℹ️ Синхронизация с GitHub выключена: она работает только с хранилищем json "
+            "в однопроцессном режиме"
+        )
+        return
+    
     await update.message.reply_text("🔄 Синхронизирую данные с GitHub...")
     
     try:
-        sync_with_github()
-        await update.message.reply_text("✅ Синхронизация завершена!")
+        await registry.flush_async()
+        async with registry.writes_paused():
+            pushed, pulled = await sync_service.sync()
+            if pulled:
+                registry.merge(load_members())
+        await registry.flush_async()
+        await update.message.reply_text(
+            f"✅ Синхронизация завершена за {sync_service.last_latency:.1f} с!\n"
+            f"Отправлено: {'да' if pushed else 'нет изменений'}, "
+            f"получено: {'да' if pulled else 'нет обновлений'}"
+        )
     except Exception as e:
-        await update.message.reply_text(f"❌ Ошибка синхронизации: {e}")
+        await update.message.reply_text(f"❌ Ошибка синхронизации: {sync_service.last_error or e}")
 
-def main():
-    setup_sync()
-    TOKEN = os.getenv('BOT_TOKEN')
+def format_stats():
+    lines = ["📊 Статистика бота:\n", "Обработчики (вызовов, среднее, p99 ≤):"]
+    for (handler,) in sorted(metrics.HANDLER_LATENCY.series):
+        count = metrics.HANDLER_LATENCY.count(handler)
+        average = metrics.HANDLER_LATENCY.total(handler) / count * 1000
+        p99 = metrics.HANDLER_LATENCY.quantile(0.99, handler) * 1000
+        lines.append(f"• {handler}: {count}, {average:.1f} мс, {p99:g} мс")
     
-    application = Application.builder().token(TOKEN).build()
+    for title, histogram in (("Чтение", metrics.STORAGE_LOAD), ("Запись", metrics.STORAGE_WRITE)):
+        count = histogram.count()
+        average = histogram.total() / count * 1000 if count else 0
+        lines.append(f"{title} хранилища: {count} раз, в среднем {average:.1f} мс")
+    
+    cache = registry.cache.stats()
+    lines.append(f"Чатов в памяти: {registry.loaded_chats}")
+    lines.append(f"Кэш упоминаний: {cache['hits']} попаданий, {cache['misses']} промахов, {cache['bytes']} байт")
+    
+    api_calls = sum(metrics.API_LATENCY.count(*labels) for labels in metrics.API_LATENCY.series)
+    api_time = sum(metrics.API_LATENCY.total(*labels) for labels in metrics.API_LATENCY.series)
+    retries = sum(metrics.API_RETRY_AFTER.values.values())
+    average = api_time / api_calls * 1000 if api_calls else 0
+    lines.append(f"Bot API: {api_calls} запросов, в среднем {average:.0f} мс, RetryAfter: {retries}")
+    
+    if not SYNC_ENABLED:
+        lines.append("Синхронизация: выключена")
+        return "\n".join(lines)
+    status = sync_service.status()
+    latency = f"{status['last_latency']:.1f} с" if status['last_latency'] is not None else "—"
+    lines.append(f"Синхронизация: {status['state']}, последняя за {latency}")
+    if status['last_error']:
+        lines.append(f"Ошибка синхронизации: {status['last_error']}")
+    return "\n".join(lines)
+
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat_member = await context.bot.get_chat_member(update.message.chat_id, update.message.from_user.id)
+    
+    if chat_member.status in ['administrator', 'creator']:
+        await update.message.reply_text(format_stats())
+    else:
+        await update.message.reply_text("❌ Эта команда только для администраторов.")
+
+async def post_init(application: Application):
+    application.bot_data['flusher'] = asyncio.create_task(registry.run_flusher())
+    if SYNC_ENABLED:
+        application.bot_data['sync'] = asyncio.create_task(sync_service.run())
+        # Опрос Telegram начинается сразу, первый git pull идет в фоне
+        application.bot_data['initial_pull'] = asyncio.create_task(pull_updates())
+    if METRICS_PORT:
+        application.bot_data['metrics_server'] = await metrics.start_metrics_server(
+            METRICS_HOST, int(METRICS_PORT)
+        )
+        print(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def post_shutdown(application: Application):
+    for name in ('flusher', 'sync', 'initial_pull'):
+        task = application.bot_data.pop(name, None)
+        if task:
+            task.cancel()
+            # Ждем, пока задача действительно завершится: запись в потоке не должна
+            # пересечься с финальной registry.flush()
+            await asyncio.gather(task, return_exceptions=True)
+    metrics_server = application.bot_data.pop('metrics_server', None)
+    if metrics_server:
+        metrics_server.close()
+    registry.flush()
+    if SYNC_ENABLED:
+        await push_on_exit()
+
+def build_application(token, **builder_options):
+    request = builder_options.pop('request', None) or HTTPXRequest(connection_pool_size=256)
+    builder = (
+        Application.builder()
+        .token(token)
+        .request(metrics.InstrumentedRequest(request))
+        .update_queue(asyncio.Queue(maxsize=UPDATE_QUEUE_SIZE))
+        .concurrent_updates(CONCURRENT_UPDATES if CONCURRENT_UPDATES > 1 else False)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    for option, value in builder_options.items():
+        builder = getattr(builder, option)(value)
+    application = builder.build()
     
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
     application.add_handler(CommandHandler("members", members_command))
     application.add_handler(CommandHandler("cleanup", cleanup_command))
-    application.add_handler(CommandHandler("sync", setup_sync))
+    application.add_handler(CommandHandler("sync", sync_command))
+    application.add_handler(CommandHandler("stats", stats_command))
+    application.add_handler(CommandHandler("import", import_command))
     application.add_handler(MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, track_new_members))
+    application.add_handler(MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, track_left_member))
+    application.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.CHAT_MEMBER))
+    application.add_handler(MessageHandler(
+        filters.UpdateType.MESSAGE & filters.TEXT & ~filters.COMMAND & mention_all_filter, handle_mention_all
+    ))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
     application.add_error_handler(error_handler)
     
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            handler.callback = metrics.instrument(handler.callback)
+    return application
+
+def run_webhook(application):
+    if not WEBHOOK_SECRET:
+        print("❌ Для режима webhook задайте WEBHOOK_SECRET")
+        sys.exit(1)
+    
+    print(f"🌐 Webhook: слушаем {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+    application.run_webhook(
+        listen=WEBHOOK_LISTEN,
+        port=WEBHOOK_PORT,
+        url_path=WEBHOOK_PATH,
+        webhook_url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=Update.ALL_TYPES,
+        max_connections=min(max(CONCURRENT_UPDATES, 40), 100)
+    )
+
+def main():
+    registry.load()
+    atexit.register(registry.flush)
+    TOKEN = os.getenv('BOT_TOKEN')
+    
+    application = build_application(TOKEN)
+    
     print("🟢 Бот запущен и готов к работе!")
     print("🤖 Бот исключает себя и других ботов из упоминаний")
     print("🛡️  Используется безопасный режим отправки сообщений")
     print("⏹️  Для остановки нажмите Ctrl+C")
     
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        run_webhook(application)
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,250 @@
+import asyncio
+import html
+import re
+import time
+from datetime import timedelta
+
+from telegram import MessageEntity
+from telegram.error import RetryAfter
+from telegram.ext import filters
+
+from metrics import MENTION_CHARS, MENTION_CHUNKS
+
+
+# Лимит Telegram на длину сообщения, в UTF-16 символах
+MESSAGE_LIMIT = 4096
+# Ограничения Bot API: ~30 сообщений в секунду всего и ~20 в минуту в одну группу
+GLOBAL_RATE = 30.0
+GLOBAL_BURST = 30
+CHAT_RATE = 20 / 60
+CHAT_BURST = 3
+MAX_RETRIES = 3
+
+MENTION_HEADER = "📢 Упоминание всех участников!\n\n"
+MEMBERS_HEADER = "📋 Список участников:\n\n"
+
+
+def text_cost(text):
+    """Длина текста так, как ее считает Telegram (UTF-16)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def render_mentions(members):
+    """Упоминания участников с заранее посчитанной длиной: [(текст, длина), ...]"""
+    mentions = []
+    for user_id, member in members.items():
+        username = member.username
+        first_name = member.first_name
+
+        if username:
+            mention = f"@{username}"
+        else:
+            mention = f"👤 {html.escape(first_name)} (ID: {user_id})"
+        mentions.append((mention, text_cost(mention)))
+    return mentions
+
+
+def render_member_lines(members):
+    """Строки для /members с заранее посчитанной длиной"""
+    lines = []
+    for user_id, member in members.items():
+        username = member.username
+        first_name = member.first_name
+
+        if username:
+            line = f"• @{username} ({first_name})"
+        else:
+            line = f"• {first_name} (ID: {user_id})"
+        lines.append((line, text_cost(line)))
+    return lines
+
+
+def chunk_parts(parts, header='', separator=' ', limit=MESSAGE_LIMIT):
+    """Разбивает части на сообщения не длиннее limit. Заголовок идет в первое сообщение"""
+    separator_cost = text_cost(separator)
+    chunks = []
+    current = [header] if header else []
+    current_cost = text_cost(header)
+    has_parts = False
+
+    for part, cost in parts:
+        extra = cost + (separator_cost if has_parts else 0)
+        if has_parts and current_cost + extra > limit:
+            chunks.append(''.join(current))
+            current, current_cost, has_parts = [], 0, False
+            extra = cost
+        if has_parts:
+            current.append(separator)
+        current.append(part)
+        current_cost += extra
+        has_parts = True
+
+    if current:
+        chunks.append(''.join(current))
+    return chunks
+
+
+class MentionAllFilter(filters.MessageFilter):
+    """Сообщения с @all или другим алиасом из aliases.
+
+    Сначала смотрим сущности-упоминания, затем ищем алиас в тексте без учета
+    регистра, не создавая копию текста в нижнем регистре. Сообщения без
+    первого символа ни одного алиаса ('@' для @all) отсекаются сразу.
+    """
+
+    def __init__(self, aliases=('@all',)):
+        self.aliases = frozenset(alias.lower() for alias in aliases)
+        # Первые символы алиасов в обоих регистрах: для "@all" это только '@'
+        self._starts = frozenset(alias[0] for alias in self.aliases) | \
+            frozenset(alias[0].upper() for alias in self.aliases)
+        # Алиас должен стоять отдельным словом: не часть адреса bob@allmail.com и не @allison
+        alternatives = '|'.join(re.escape(alias) for alias in self.aliases)
+        self._pattern = re.compile(rf'(?<![\w@])(?:{alternatives})(?!\w)', re.IGNORECASE)
+        super().__init__(name=f"MentionAllFilter({', '.join(sorted(self.aliases))})")
+
+    def filter(self, message):
+        text = message.text
+        if not text or not any(start in text for start in self._starts):
+            return False
+        for entity in message.entities:
+            if entity.type == MessageEntity.MENTION:
+                mention = text[entity.offset:entity.offset + entity.length]
+                if mention.lower() in self.aliases:
+                    return True
+        return self._pattern.search(text) is not None
+
+
+def retry_seconds(error):
+    delay = error.retry_after
+    if isinstance(delay, timedelta):
+        return delay.total_seconds()
+    return float(delay)
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    @property
+    def idle(self):
+        now = time.monotonic()
+        self._refill(now)
+        return self._tokens >= self.capacity and now >= self._blocked_until
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def pause(self, delay):
+        """Блокирует выдачу токенов на delay секунд (после RetryAfter)"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        self._tokens = 0.0
+
+
+class RateLimiter:
+    """Общий лимит на бота плюс отдельный лимит на каждый чат"""
+
+    def __init__(self, global_rate=GLOBAL_RATE, global_burst=GLOBAL_BURST,
+                 chat_rate=CHAT_RATE, chat_burst=CHAT_BURST):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self._global = TokenBucket(global_rate, global_burst)
+        self._chats = {}
+
+    def _bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= 1000:
+                self._chats = {key: value for key, value in self._chats.items() if not value.idle}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def acquire(self, chat_id):
+        await self._bucket(chat_id).acquire()
+        await self._global.acquire()
+
+    def pause(self, chat_id, delay):
+        self._bucket(chat_id).pause(delay)
+        self._global.pause(delay)
+
+
+class MentionDispatcher:
+    """Отправляет длинные тексты частями через RateLimiter.
+
+    Отправка идет в фоне, чтобы ожидание лимитов не задерживало обработку
+    других обновлений. Одновременные @all (или /members) в одном чате
+    объединяются в одну отправку.
+    """
+
+    def __init__(self, limiter=None, max_retries=MAX_RETRIES):
+        self.limiter = limiter or RateLimiter()
+        self.max_retries = max_retries
+        # (chat_id, вид) -> задача отправки
+        self._sending = {}
+
+    def in_progress(self, chat_id, kind='mentions'):
+        return (chat_id, kind) in self._sending
+
+    async def send(self, bot, chat_id, text, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire(chat_id)
+            try:
+                return await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.limiter.pause(chat_id, retry_seconds(e))
+
+    async def send_chunks(self, bot, chat_id, chunks, reply_to=None):
+        for index, chunk in enumerate(chunks):
+            if index == 0 and reply_to is not None:
+                await self.send(bot, chat_id, chunk, reply_to_message_id=reply_to)
+            else:
+                await self.send(bot, chat_id, chunk)
+
+    def start_send(self, bot, chat_id, chunks, reply_to=None, create_task=asyncio.create_task,
+                   kind='mentions'):
+        """Отправляет chunks в фоне и сразу возвращает задачу.
+
+        Если в чате уже идет отправка того же вида, новая не начинается и
+        возвращается None. create_task позволяет передать Application.create_task,
+        чтобы ошибки попали в обработчик ошибок бота.
+        """
+        key = (chat_id, kind)
+        if key in self._sending:
+            return None
+        task = create_task(self.send_chunks(bot, chat_id, chunks, reply_to))
+        self._sending[key] = task
+        task.add_done_callback(lambda _: self._sending.pop(key, None))
+        return task
+
+    async def wait(self):
+        """Ждет окончания всех начатых отправок"""
+        while self._sending:
+            await asyncio.gather(*self._sending.values(), return_exceptions=True)
+
+    def start_fan_out(self, bot, chat_id, chunks, reply_to=None, create_task=asyncio.create_task):
+        """Рассылка упоминаний в фоне (см. start_send). None, если рассылка уже идет"""
+        if self.in_progress(chat_id):
+            return None
+        MENTION_CHUNKS.observe(len(chunks))
+        MENTION_CHARS.observe(sum(len(chunk) for chunk in chunks))
+        return self.start_send(bot, chat_id, chunks, reply_to, create_task)
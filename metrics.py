@@ -0,0 +1,288 @@
+import asyncio
+import bisect
+import cProfile
+import os
+import random
+import time
+from contextlib import contextmanager
+from functools import partial, wraps
+
+from telegram.error import RetryAfter
+from telegram.request import BaseRequest
+
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
+COUNT_BUCKETS = (1, 2, 3, 5, 10, 20, 50)
+SYNC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{value}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def snapshot(self):
+        return dict(self.values)
+
+    def merged(self, snapshots):
+        """Новый счетчик с суммой значений из снимков нескольких процессов"""
+        counter = Counter(self.name, self.help, self.labels)
+        for values in snapshots:
+            for label_values, value in values.items():
+                counter.inc(*label_values, amount=value)
+        return counter
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, label_values)} {value}")
+        return lines
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами: observe() - bisect и два сложения"""
+
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def count(self, *label_values):
+        series = self.series.get(label_values)
+        return sum(series[0]) if series else 0
+
+    def total(self, *label_values):
+        series = self.series.get(label_values)
+        return series[1] if series else 0.0
+
+    def quantile(self, fraction, *label_values):
+        """Верхняя граница корзины, в которую попадает квантиль"""
+        series = self.series.get(label_values)
+        if not series:
+            return 0.0
+        target = fraction * sum(series[0])
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), series[0]):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def snapshot(self):
+        return {label_values: [list(counts), total] for label_values, (counts, total) in self.series.items()}
+
+    def merged(self, snapshots):
+        """Новая гистограмма с суммой корзин из снимков нескольких процессов"""
+        histogram = Histogram(self.name, self.help, self.labels, self.buckets)
+        for series in snapshots:
+            for label_values, (counts, total) in series.items():
+                merged = histogram.series.setdefault(label_values, [[0] * len(counts), 0.0])
+                merged[0] = [a + b for a, b in zip(merged[0], counts)]
+                merged[1] += total
+        return histogram
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for label_values, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                labels = _format_labels(self.labels, label_values, [('le', le)])
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+HANDLER_LATENCY = Histogram(
+    'bot_handler_seconds', 'Время обработки обновления', ('handler',))
+HANDLER_ERRORS = Counter(
+    'bot_handler_errors_total', 'Исключения в обработчиках', ('handler',))
+STORAGE_LOAD = Histogram(
+    'bot_storage_load_seconds', 'Чтение участников из хранилища')
+STORAGE_WRITE = Histogram(
+    'bot_storage_write_seconds', 'Запись изменений участников в хранилище')
+MENTION_CHARS = Histogram(
+    'bot_mention_text_chars', 'Длина текста упоминаний @all', buckets=SIZE_BUCKETS)
+MENTION_CHUNKS = Histogram(
+    'bot_mention_chunks', 'Число сообщений в одной рассылке', buckets=COUNT_BUCKETS)
+API_LATENCY = Histogram(
+    'bot_telegram_api_seconds', 'Время запросов к Bot API', ('method',))
+API_RETRY_AFTER = Counter(
+    'bot_telegram_retry_after_total', 'Ответы RetryAfter от Bot API', ('method',))
+SYNC_DURATION = Histogram(
+    'bot_git_sync_seconds', 'Длительность git-операций', ('operation',), buckets=SYNC_BUCKETS)
+
+METRICS = (
+    HANDLER_LATENCY, HANDLER_ERRORS, STORAGE_LOAD, STORAGE_WRITE, MENTION_CHARS,
+    MENTION_CHUNKS, API_LATENCY, API_RETRY_AFTER, SYNC_DURATION
+)
+
+
+def render(metrics=METRICS):
+    """Все метрики в текстовом формате Prometheus"""
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    """Значения всех метрик процесса, которые можно передать через multiprocessing"""
+    return {metric.name: metric.snapshot() for metric in METRICS}
+
+
+def merge_snapshots(snapshots):
+    """Метрики, сложенные по снимкам нескольких процессов (для render)"""
+    return [metric.merged([item[metric.name] for item in snapshots if metric.name in item])
+            for metric in METRICS]
+
+
+class Profiler:
+    """Выборочный cProfile: сохраняет профиль обновлений, обработанных дольше slow_ms"""
+
+    def __init__(self, sample_rate=0.0, slow_ms=500.0, directory='profiles'):
+        self.sample_rate = sample_rate
+        self.slow_seconds = slow_ms / 1000
+        self.directory = directory
+        self._active = False
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def should_sample(self):
+        # Профилировщик не реентерабелен, при одновременных обновлениях берем только одно
+        return random.random() < self.sample_rate and not self._active
+
+    async def run(self, name, coroutine):
+        profile = cProfile.Profile()
+        self._active = True
+        started = time.perf_counter()
+        profile.enable()
+        try:
+            return await coroutine
+        finally:
+            profile.disable()
+            self._active = False
+            elapsed = time.perf_counter() - started
+            if elapsed >= self.slow_seconds:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, f"{name}-{int(time.time() * 1000)}.prof")
+                profile.dump_stats(path)
+                print(f"🐢 {name} обработан за {elapsed * 1000:.0f} мс, профиль: {path}")
+
+
+profiler = Profiler(
+    float(os.getenv('PROFILE_SAMPLE_RATE', '0')),
+    float(os.getenv('PROFILE_SLOW_MS', '500')),
+    os.getenv('PROFILE_DIR', 'profiles')
+)
+
+
+def instrument(callback):
+    """Оборачивает обработчик: гистограмма времени, счетчик ошибок, выборочный профиль"""
+    name = callback.__name__
+
+    @wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            if profiler.enabled and profiler.should_sample():
+                return await profiler.run(name, callback(update, context))
+            return await callback(update, context)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_LATENCY.observe(time.perf_counter() - started, name)
+
+    return wrapper
+
+
+class InstrumentedRequest(BaseRequest):
+    """Обертка над запросами к Bot API: время ответа и число RetryAfter по методам"""
+
+    def __init__(self, request):
+        self._request = request
+
+    @property
+    def read_timeout(self):
+        return self._request.read_timeout
+
+    async def initialize(self):
+        await self._request.initialize()
+
+    async def shutdown(self):
+        await self._request.shutdown()
+
+    async def do_request(self, *args, **kwargs):
+        return await self._request.do_request(*args, **kwargs)
+
+    async def post(self, url, *args, **kwargs):
+        method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        try:
+            return await super().post(url, *args, **kwargs)
+        except RetryAfter:
+            API_RETRY_AFTER.inc(method)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - started, method)
+
+
+async def _handle_http(render_page, reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+            pass
+        parts = request_line.decode('latin-1').split()
+        if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+            status, body = '200 OK', render_page().encode('utf-8')
+        else:
+            status, body = '404 Not Found', b'not found\n'
+        writer.write(
+            f"HTTP/1.1 {status}\r\n"
+            f"Content-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: close\r\n\r\n".encode('latin-1') + body
+        )
+        await writer.drain()
+    finally:
+        writer.close()
+
+
+async def start_metrics_server(host, port, render_page=render):
+    """Локальный HTTP-сервер с одной страницей /metrics, текст страницы дает render_page()"""
+    return await asyncio.start_server(partial(_handle_http, render_page), host, port)
@@ -0,0 +1,21 @@
+# migrate_members.py
+import sys
+
+from storage import BACKENDS, convert_members
+
+
+def main():
+    json_path = sys.argv[1] if len(sys.argv) > 1 else "members.json"
+    target = sys.argv[2] if len(sys.argv) > 2 else "members.db"
+    backend = sys.argv[3] if len(sys.argv) > 3 else "sqlite"
+
+    if backend not in BACKENDS:
+        print(f"❌ Неизвестное хранилище {backend}, доступны: {', '.join(BACKENDS)}")
+        sys.exit(1)
+
+    count = convert_members(json_path, backend, target)
+    print(f"✅ Перенесено {count} записей из {json_path} в {target}")
+    print(f"ℹ️ Для работы с ним запустите бота с MEMBERS_BACKEND={backend}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,701 @@
+import asyncio
+import contextlib
+import json
+import os
+import sqlite3
+import tempfile
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import STORAGE_LOAD, STORAGE_WRITE
+
+
+DEFAULT_FIRST_NAME = 'Участник'
+
+
+def read_members_file(path):
+    """Читаем members.json целиком"""
+    if os.path.exists(path):
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            print(f"❌ Ошибка чтения {path}, создаем новый файл")
+            return {}
+    return {}
+
+
+def write_members_file(path, payload):
+    """Атомарно записываем готовый JSON: временный файл + rename"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.members-', suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+class Member:
+    """Участник чата. Два слота вместо словаря; одинаковые имена хранятся один раз"""
+
+    __slots__ = ('username', 'first_name')
+
+    def __init__(self, username, first_name):
+        self.username = sys.intern(username) if username else None
+        self.first_name = sys.intern(first_name or DEFAULT_FIRST_NAME)
+
+    def __eq__(self, other):
+        if not isinstance(other, Member):
+            return NotImplemented
+        return self.username == other.username and self.first_name == other.first_name
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"Member({self.username!r}, {self.first_name!r})"
+
+    def to_dict(self):
+        return {'username': self.username, 'first_name': self.first_name}
+
+
+def members_from_json(data):
+    """Формат members.json ({"chat": {"user": {...}}}) -> {chat: {user: Member}}"""
+    return {
+        int(chat_key): {
+            int(user_key): Member(record.get('username'), record.get('first_name'))
+            for user_key, record in chat.items()
+        }
+        for chat_key, chat in data.items()
+    }
+
+
+def members_to_json(members):
+    return {
+        str(chat_key): {str(user_key): member.to_dict() for user_key, member in chat.items()}
+        for chat_key, chat in members.items()
+    }
+
+
+class JsonBackend:
+    """Хранилище в одном members.json: формат {chat_id: {user_id: {...}}}"""
+
+    lazy = False
+
+    def __init__(self, path):
+        self.path = path
+        # chat -> (словарь чата в реестре, его копия из прошлого снимка)
+        self._copies = {}
+
+    def load_all(self):
+        return members_from_json(read_members_file(self.path))
+
+    def load_chat(self, chat_id):
+        return self.load_all().get(int(chat_id))
+
+    def snapshot(self, members, upserts, clears):
+        """Копии чатов на момент снимка: заново копируются только измененные чаты.
+
+        Формат файла не позволяет менять часть данных, поэтому JSON всего
+        хранилища собирается в write(), уже в потоке записи.
+        """
+        changed = set(clears)
+        changed.update(chat_key for chat_key, _ in upserts)
+        copies = {}
+        for chat_key, chat in members.items():
+            cached = self._copies.get(chat_key)
+            if cached is None or cached[0] is not chat or chat_key in changed:
+                cached = (chat, dict(chat))
+            copies[chat_key] = cached
+        self._copies = copies
+        return {chat_key: copy for chat_key, (_, copy) in copies.items()}
+
+    def write(self, payload):
+        write_members_file(self.path, json.dumps(members_to_json(payload), ensure_ascii=False, indent=2))
+
+    def close(self):
+        pass
+
+
+class SqliteBackend:
+    """Хранилище в SQLite (WAL) с ключом (chat_id, user_id).
+
+    Чаты подгружаются по одному при первом обращении, а запись затрагивает
+    только измененные строки и очищенные чаты.
+    """
+
+    lazy = True
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = None
+
+    @property
+    def _conn(self):
+        # Подключаемся при первом обращении, чтобы создание хранилища не трогало диск
+        if self._connection is None:
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS members ("
+                " chat_id INTEGER NOT NULL,"
+                " user_id INTEGER NOT NULL,"
+                " username TEXT,"
+                " first_name TEXT NOT NULL,"
+                " PRIMARY KEY (chat_id, user_id)"
+                ") WITHOUT ROWID"
+            )
+            connection.commit()
+            self._connection = connection
+        return self._connection
+
+    def load_all(self):
+        members = {}
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT chat_id, user_id, username, first_name FROM members"
+            ).fetchall()
+        for chat_id, user_id, username, first_name in rows:
+            members.setdefault(chat_id, {})[user_id] = Member(username, first_name)
+        return members
+
+    def load_chat(self, chat_id):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT user_id, username, first_name FROM members WHERE chat_id = ?",
+                (int(chat_id),)
+            ).fetchall()
+        if not rows:
+            return None
+        return {user_id: Member(username, first_name) for user_id, username, first_name in rows}
+
+    def snapshot(self, members, upserts, clears):
+        rows = []
+        removals = []
+        for (chat_key, user_key), record in upserts.items():
+            if record is None:
+                removals.append((chat_key, user_key))
+            else:
+                rows.append((chat_key, user_key, record.username, record.first_name))
+        return [(chat_key,) for chat_key in clears], removals, rows
+
+    def write(self, payload):
+        clears, removals, rows = payload
+        with self._lock, self._conn:
+            self._conn.executemany("DELETE FROM members WHERE chat_id = ?", clears)
+            self._conn.executemany("DELETE FROM members WHERE chat_id = ? AND user_id = ?", removals)
+            self._conn.executemany(
+                "INSERT INTO members (chat_id, user_id, username, first_name) "
+                "VALUES (?, ?, ?, ?) "
+                "ON CONFLICT (chat_id, user_id) DO UPDATE SET "
+                "username = excluded.username, first_name = excluded.first_name",
+                rows
+            )
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+
+class SegmentBackend:
+    """Каталог с отдельным компактным файлом на чат: <chat_id>.json.
+
+    Файл чата читается при первом обращении к нему, а запись затрагивает
+    только измененные чаты, так что время старта не зависит от числа чатов.
+    """
+
+    lazy = True
+
+    def __init__(self, path):
+        self.path = path
+
+    def _segment(self, chat_key):
+        return os.path.join(self.path, f"{chat_key}.json")
+
+    def _read(self, segment):
+        with open(segment, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return {int(user_key): Member(username, first_name) for user_key, (username, first_name) in data.items()}
+
+    def load_all(self):
+        if not os.path.isdir(self.path):
+            return {}
+        return {
+            int(name[:-5]): self._read(os.path.join(self.path, name))
+            for name in os.listdir(self.path)
+            if name.endswith('.json') and not name.startswith('.')
+        }
+
+    def load_chat(self, chat_id):
+        segment = self._segment(int(chat_id))
+        if not os.path.exists(segment):
+            return None
+        return self._read(segment)
+
+    def snapshot(self, members, upserts, clears):
+        changed = set(clears)
+        changed.update(chat_key for chat_key, _ in upserts)
+        return {
+            chat_key: json.dumps(
+                {str(user_key): [member.username, member.first_name]
+                 for user_key, member in members.get(chat_key, {}).items()},
+                ensure_ascii=False, separators=(',', ':')
+            )
+            for chat_key in changed
+        }
+
+    def write(self, payload):
+        os.makedirs(self.path, exist_ok=True)
+        for chat_key, data in payload.items():
+            write_members_file(self._segment(chat_key), data)
+
+    def close(self):
+        pass
+
+
+BACKENDS = {
+    'json': JsonBackend,
+    'sqlite': SqliteBackend,
+    'segments': SegmentBackend,
+}
+
+
+def create_backend(name, path):
+    try:
+        backend_class = BACKENDS[name]
+    except KeyError:
+        raise ValueError(f"Неизвестное хранилище: {name}") from None
+    return backend_class(path)
+
+
+def convert_members(json_path, backend_name, target):
+    """Переносит участников из members.json в хранилище backend_name. Возвращает число записей"""
+    members = members_from_json(read_members_file(json_path))
+    upserts = {
+        (chat_key, user_key): member
+        for chat_key, chat in members.items()
+        for user_key, member in chat.items()
+    }
+    backend = create_backend(backend_name, target)
+    try:
+        backend.write(backend.snapshot(members, upserts, set(members)))
+    finally:
+        backend.close()
+    return len(upserts)
+
+
+class RenderCache:
+    """LRU-кэш готовых текстов по чатам с ограничением по памяти.
+
+    Значения - списки строк (части сообщений), размер считается по
+    sys.getsizeof строк.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._kinds = {}
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value):
+        size = sum(sys.getsizeof(item) for item in value)
+        self._remove(key)
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (value, size)
+        self._kinds.setdefault(key[0], set()).add(key[1])
+        self.size += size
+        while self.size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry[1]
+        kinds = self._kinds[key[0]]
+        kinds.discard(key[1])
+        if not kinds:
+            del self._kinds[key[0]]
+
+    def invalidate(self, chat_key):
+        for kind in list(self._kinds.get(chat_key, ())):
+            self._remove((chat_key, kind))
+
+    def stats(self):
+        return {
+            'entries': len(self._entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+
+
+class RecentlySeen:
+    """Кого из участников чата видели за последние ttl секунд.
+
+    Повторное сообщение от такого участника не требует обращения к реестру.
+    """
+
+    def __init__(self, ttl=300.0, max_chats=100000):
+        self.ttl = ttl
+        self.max_chats = max_chats
+        self._seen = {}
+
+    def check(self, chat_id, user_id):
+        """True, если участника недавно видели; иначе запоминает его и возвращает False"""
+        now = time.monotonic()
+        chat = self._seen.get(chat_id)
+        if chat is None:
+            if len(self._seen) >= self.max_chats:
+                self._purge(now)
+            chat = self._seen[chat_id] = {}
+        expires = chat.get(user_id)
+        if expires is not None and expires > now:
+            return True
+        chat[user_id] = now + self.ttl
+        return False
+
+    def forget(self, chat_id, user_id):
+        chat = self._seen.get(chat_id)
+        if chat is not None:
+            chat.pop(user_id, None)
+
+    def forget_chat(self, chat_id):
+        self._seen.pop(chat_id, None)
+
+    def _purge(self, now):
+        for chat_id in list(self._seen):
+            chat = {user_id: expires for user_id, expires in self._seen[chat_id].items() if expires > now}
+            if chat:
+                self._seen[chat_id] = chat
+            else:
+                del self._seen[chat_id]
+
+
+class MemberRegistry:
+    """Участники в памяти процесса с отложенной записью в хранилище.
+
+    Изменения копятся в памяти, а запись выполняется пачками: по таймеру,
+    при накоплении flush_threshold изменений и при завершении работы.
+    JSON-хранилище читается целиком при старте, SQLite - по чатам по мере
+    обращения. Готовые тексты упоминаний хранятся в cache и сбрасываются
+    только при изменении состава чата.
+
+    Участники из сообщений и событий о входе/выходе ставятся в очередь
+    (queue_upsert/queue_remove) и применяются к чату одной пачкой: перед
+    чтением этого чата или перед записью в хранилище.
+
+    Ключи - целые chat_id и user_id. Для хранилищ с загрузкой по чатам чаты
+    без несохраненных изменений выгружаются из памяти, если к ним не
+    обращались idle_ttl секунд или загружено больше max_chats чатов.
+    """
+
+    def __init__(self, backend, flush_interval=5.0, flush_threshold=100, cache_bytes=8 * 1024 * 1024,
+                 idle_ttl=3600.0, max_chats=10000):
+        self.backend = backend
+        self.idle_ttl = idle_ttl
+        self.max_chats = max_chats
+        self.cache = RenderCache(cache_bytes)
+        # Вызывается после каждой успешной записи (например, чтобы запланировать git push)
+        self.on_flush = None
+        self.flush_interval = flush_interval
+        self.flush_threshold = flush_threshold
+        self._members = {}
+        self._last_access = {}
+        # (chat, user) -> запись или None, если участника нужно удалить
+        self._upserts = {}
+        self._clears = set()
+        self._dirty = 0
+        self._pending = {}
+        self._queued = 0
+        self._wakeup = asyncio.Event()
+        # Снимок и запись выполняются строго по очереди, иначе старый снимок может лечь поверх нового
+        self._write_lock = asyncio.Lock()
+
+    def load(self):
+        with STORAGE_LOAD.time():
+            self._members = {} if self.backend.lazy else self.backend.load_all()
+        self._last_access = {}
+        self._upserts = {}
+        self._clears = set()
+        self._dirty = 0
+        self._pending = {}
+        self._queued = 0
+        self.cache = RenderCache(self.cache.max_bytes)
+
+    @property
+    def dirty(self):
+        return self._dirty > 0 or self._queued > 0
+
+    def _chat(self, chat_key):
+        if self.backend.lazy:
+            self._last_access[chat_key] = time.monotonic()
+            if chat_key not in self._members:
+                with STORAGE_LOAD.time():
+                    chat = self.backend.load_chat(chat_key)
+                if chat is not None:
+                    self._members[chat_key] = chat
+        return self._members.get(chat_key)
+
+    @property
+    def loaded_chats(self):
+        return len(self._members)
+
+    def get_chat(self, chat_id):
+        chat_key = int(chat_id)
+        if chat_key in self._pending:
+            self._apply_pending(chat_key)
+        return self._chat(chat_key) or {}
+
+    def rendered(self, chat_id, kind, render):
+        """Текст вида kind для чата из кэша; при промахе строится через render(members)"""
+        key = (int(chat_id), kind)
+        if key[0] in self._pending:
+            self._apply_pending(key[0])
+        value = self.cache.get(key)
+        if value is None:
+            value = render(self.get_chat(chat_id))
+            self.cache.put(key, value)
+        return value
+
+    def upsert(self, chat_id, user_id, username, first_name):
+        """Добавляет или обновляет участника сразу. Возвращает True, если данные изменились"""
+        chat_key = int(chat_id)
+        if chat_key in self._pending:
+            self._apply_pending(chat_key)
+        return self._apply(chat_key, {int(user_id): Member(username, first_name)})
+
+    def queue_upsert(self, chat_id, user_id, username, first_name):
+        """Ставит добавление участника в очередь чата"""
+        self._queue(int(chat_id), int(user_id), Member(username, first_name))
+
+    def queue_remove(self, chat_id, user_id):
+        """Ставит удаление участника в очередь чата"""
+        self._queue(int(chat_id), int(user_id), None)
+
+    def _queue(self, chat_key, user_key, record):
+        batch = self._pending.setdefault(chat_key, {})
+        # Считаем записи в очереди, а не вызовы: повтор заменяет запись в пачке
+        if user_key not in batch:
+            self._queued += 1
+        batch[user_key] = record
+        if self._queued >= self.flush_threshold:
+            self._wakeup.set()
+
+    def _apply_pending(self, chat_key):
+        batch = self._pending.pop(chat_key, None)
+        if batch:
+            self._queued -= len(batch)
+            self._apply(chat_key, batch)
+
+    def apply_pending(self):
+        """Применяет очереди всех чатов. Возвращает число измененных чатов"""
+        changed = 0
+        for chat_key in list(self._pending):
+            batch = self._pending.pop(chat_key)
+            changed += self._apply(chat_key, batch)
+        self._queued = 0
+        return changed
+
+    def _apply(self, chat_key, batch):
+        """Применяет изменения {user: запись или None} к чату. True, если что-то изменилось"""
+        chat = self._chat(chat_key)
+        if chat is None:
+            if all(record is None for record in batch.values()):
+                return False
+            chat = self._members[chat_key] = {}
+
+        changed = False
+        for user_key, record in batch.items():
+            if record is None:
+                if chat.pop(user_key, None) is None:
+                    continue
+            elif chat.get(user_key) == record:
+                continue
+            else:
+                chat[user_key] = record
+            self._upserts[(chat_key, user_key)] = record
+            changed = True
+
+        if changed:
+            self.cache.invalidate(chat_key)
+            self._mark_dirty()
+        return changed
+
+    def clear_chat(self, chat_id):
+        """Очищает список участников чата. Возвращает число удаленных или None, если чата нет"""
+        chat_key = int(chat_id)
+        if chat_key in self._pending:
+            self._apply_pending(chat_key)
+        chat = self._chat(chat_key)
+        if chat is None:
+            return None
+
+        count = len(chat)
+        self._members[chat_key] = {}
+        self.cache.invalidate(chat_key)
+        for key in [key for key in self._upserts if key[0] == chat_key]:
+            del self._upserts[key]
+        self._clears.add(chat_key)
+        self._mark_dirty()
+        return count
+
+    def merge(self, members):
+        """Добавляет участников ({chat: {user: Member}}), которых еще нет в памяти"""
+        added = 0
+        for chat_key, chat in members.items():
+            known = self.get_chat(chat_key)
+            batch = {user_key: member for user_key, member in chat.items() if user_key not in known}
+            if batch:
+                self._apply(chat_key, batch)
+                added += len(batch)
+        return added
+
+    def evict_idle(self):
+        """Выгружает из памяти давно не использованные чаты без несохраненных изменений"""
+        if not self.backend.lazy:
+            return 0
+        busy = self._clears | set(self._pending)
+        busy.update(chat_key for chat_key, _ in self._upserts)
+        deadline = time.monotonic() - self.idle_ttl
+        by_age = sorted(self._last_access.items(), key=lambda item: item[1])
+        excess = len(by_age) - self.max_chats
+
+        evicted = 0
+        for chat_key, last_access in by_age:
+            if last_access > deadline and evicted >= excess:
+                break
+            if chat_key in busy:
+                continue
+            self._members.pop(chat_key, None)
+            del self._last_access[chat_key]
+            self.cache.invalidate(chat_key)
+            evicted += 1
+        return evicted
+
+    def _mark_dirty(self):
+        self._dirty += 1
+        if self._dirty >= self.flush_threshold:
+            self._wakeup.set()
+
+    def _snapshot(self):
+        payload = self.backend.snapshot(self._members, self._upserts, self._clears)
+        self._upserts = {}
+        self._clears = set()
+        self._dirty = 0
+        return payload
+
+    def flush(self):
+        """Синхронная запись в хранилище, если есть изменения.
+
+        Вызывается, когда фоновые записи уже завершены (при остановке, из atexit)
+        """
+        self.apply_pending()
+        if not self._dirty:
+            return False
+        with STORAGE_WRITE.time():
+            self.backend.write(self._snapshot())
+        self._flushed()
+        return True
+
+    async def flush_async(self):
+        """Снимок делаем в потоке цикла событий, а пишем в отдельном потоке"""
+        async with self._write_lock:
+            self.apply_pending()
+            if not self._dirty:
+                return False
+            upserts, clears = self._upserts, self._clears
+            started = time.perf_counter()
+            payload = self._snapshot()
+            write = asyncio.ensure_future(asyncio.to_thread(self.backend.write, payload))
+            try:
+                try:
+                    await asyncio.shield(write)
+                except asyncio.CancelledError:
+                    # Поток записи не отменить: держим блокировку, пока он не закончит
+                    await write
+                    raise
+            except Exception:
+                # Возвращаем несохраненные изменения, более новые не перетираем.
+                # Чаты, очищенные за время записи, не восстанавливаем
+                cleared_since = set(self._clears)
+                for key, record in upserts.items():
+                    if key[0] not in cleared_since:
+                        self._upserts.setdefault(key, record)
+                self._clears |= clears
+                self._dirty += 1
+                raise
+            finally:
+                STORAGE_WRITE.observe(time.perf_counter() - started)
+        self._flushed()
+        return True
+
+    @contextlib.asynccontextmanager
+    async def writes_paused(self):
+        """Запись в хранилище ждет, пока блок не завершится.
+
+        Внутри блока файл хранилища может менять внешний процесс (git pull).
+        После блока реестр считается измененным, и следующая запись заново
+        сохраняет данные из памяти (для JSON - файл целиком).
+        """
+        async with self._write_lock:
+            try:
+                yield
+            finally:
+                self._mark_dirty()
+
+    def _flushed(self):
+        if self.on_flush is not None:
+            self.on_flush()
+
+    async def run_flusher(self):
+        """Фоновая задача: сбрасывает изменения по таймеру или по порогу"""
+        # Срок считается от прошлой записи: пробуждения очередью его не сдвигают
+        deadline = time.monotonic() + self.flush_interval
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                pass
+            else:
+                # Разбудила длинная очередь: применяем ее, а пишем только при
+                # накоплении flush_threshold реальных изменений или по сроку
+                self._wakeup.clear()
+                self.apply_pending()
+                if self._dirty < self.flush_threshold and time.monotonic() < deadline:
+                    continue
+            deadline = time.monotonic() + self.flush_interval
+            try:
+                await self.flush_async()
+            except Exception as e:
+                print(f"❌ Ошибка записи участников: {e}")
+            # Выгружаем только здесь: пока идет запись, выгружать чаты нельзя
+            self.evict_idle()
@@ -0,0 +1,80 @@
+# stub_api.py
+import json
+from itertools import count
+
+from telegram.request import BaseRequest
+
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'AllBot', 'username': 'all_bot'}
+
+
+class StubRequest(BaseRequest):
+    """Локальная заглушка Bot API: отвечает без сети и запоминает вызовы.
+
+    Передается в Application.builder().request(...) вместо HTTPXRequest.
+    """
+
+    def __init__(self, admin_ids=None):
+        self.admin_ids = set(admin_ids or ())
+        # По умолчанию все пользователи считаются администраторами
+        self.everyone_admin = admin_ids is None
+        self.calls = []
+        self._message_ids = count(1)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def read_timeout(self):
+        return 5.0
+
+    def _user(self, user_id):
+        return {'id': int(user_id), 'is_bot': False, 'first_name': f'User {user_id}'}
+
+    def _status(self, user_id):
+        if self.everyone_admin or int(user_id) in self.admin_ids:
+            return 'administrator'
+        return 'member'
+
+    def _chat_member(self, user_id):
+        member = {'user': self._user(user_id), 'status': self._status(user_id)}
+        if member['status'] == 'administrator':
+            member.update({
+                'can_be_edited': False, 'is_anonymous': False, 'can_manage_chat': True,
+                'can_delete_messages': True, 'can_manage_video_chats': True,
+                'can_restrict_members': True, 'can_promote_members': False,
+                'can_change_info': True, 'can_invite_users': True,
+                'can_post_stories': False, 'can_edit_stories': False,
+                'can_delete_stories': False
+            })
+        return member
+
+    def _result(self, method, params):
+        if method == 'getMe':
+            return BOT_USER
+        if method in ('sendMessage', 'editMessageText'):
+            return {
+                'message_id': next(self._message_ids),
+                'date': 0,
+                'chat': {'id': int(params['chat_id']), 'type': 'supergroup'},
+                'from': BOT_USER,
+                'text': params.get('text', '')
+            }
+        if method == 'getChatMember':
+            return self._chat_member(params['user_id'])
+        if method == 'getChatAdministrators':
+            return [self._chat_member(user_id) for user_id in sorted(self.admin_ids)]
+        if method == 'getUpdates':
+            return []
+        return True
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None,
+                         write_timeout=None, connect_timeout=None, pool_timeout=None):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        self.calls.append((api_method, params))
+        body = {'ok': True, 'result': self._result(api_method, params)}
+        return 200, json.dumps(body).encode('utf-8')
@@ -0,0 +1,333 @@
+# supervisor.py
+"""Запуск бота в несколько процессов с разбиением чатов по chat_id.
+
+Один входной процесс получает обновления (polling или webhook, как в
+main.py) и передает каждое в воркер с номером chat_id % K. Каждый воркер
+сам хранит участников своих чатов в отдельном файле (members.shard<N>.json
+, .db или каталог members.shard<N>.d), поэтому межпроцессные блокировки не нужны. При первом запуске
+воркер забирает свои чаты из общего members.json.
+
+Синхронизация с GitHub в этом режиме выключена: файлы воркеров не
+хранятся в git, а /sync в воркере отвечает, что синхронизация недоступна.
+Страницу /metrics (METRICS_PORT) отдает супервизор: метрики воркеров
+складываются, /stats в чате показывает только метрики своего воркера.
+
+    python supervisor.py --workers 4
+    BOT_MODE=webhook WEBHOOK_SECRET=s python supervisor.py --workers 4 --stub
+
+Число воркеров нельзя менять без переноса данных: чаты перераспределятся.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+
+STUB_TOKEN = '0:stub'
+METRICS_INTERVAL = 5.0
+RESTART_DELAY = 1.0
+# Пауза воркера, когда очередь пуста, и ожидание при переносе очереди упавшего воркера
+POLL_INTERVAL = 0.01
+DRAIN_TIMEOUT = 0.2
+# Как часто супервизор печатает сводку по воркерам (0 - не печатать)
+STATUS_INTERVAL = float(os.getenv('SUPERVISOR_STATUS_INTERVAL', '60'))
+
+
+def shard_for(chat_id, shards):
+    return chat_id % shards if chat_id is not None else 0
+
+
+def shard_path(index, path):
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard{index}{ext}"
+
+
+def run_worker(index, shards, updates, metrics, token, stub):
+    """Точка входа процесса-воркера"""
+    # Ctrl+C получает вся группа процессов, а воркер останавливается по команде супервизора
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    source_file = os.getenv('MEMBERS_FILE', 'members.json')
+    os.environ['MEMBERS_FILE'] = shard_path(index, source_file)
+    os.environ['MEMBERS_DB'] = shard_path(index, os.getenv('MEMBERS_DB', 'members.db'))
+    os.environ['MEMBERS_DIR'] = shard_path(index, os.getenv('MEMBERS_DIR', 'members.d'))
+    # Несколько процессов не могут безопасно запускать git в одном рабочем каталоге
+    os.environ['GIT_SYNC'] = '0'
+
+    asyncio.run(serve_shard(index, shards, updates, metrics, token, stub, source_file))
+
+
+async def serve_shard(index, shards, updates, metrics, token, stub, source_file):
+    import main
+    from storage import members_from_json, read_members_file
+    from telegram import Update
+
+    seed = not os.path.exists(main.STORAGE_PATHS[main.STORAGE_BACKEND])
+    main.registry.load()
+    if seed:
+        members = members_from_json(read_members_file(source_file))
+        main.registry.merge({
+            chat_key: chat for chat_key, chat in members.items()
+            if shard_for(chat_key, shards) == index
+        })
+        main.registry.flush()
+
+    builder_options = {'updater': None}
+    if stub:
+        from stub_api import StubRequest
+        builder_options['request'] = StubRequest()
+    application = main.build_application(token, **builder_options)
+
+    processed = 0
+    last_report = 0.0
+
+    async with application:
+        await application.start()
+        flusher = asyncio.create_task(main.registry.run_flusher())
+        print(f"🟢 Воркер {index} запущен (pid {os.getpid()})")
+        try:
+            while True:
+                try:
+                    # Не ждем на блокировке очереди: она берется только на время чтения
+                    # одного обновления, и упавший воркер почти никогда не уносит ее с собой
+                    data = updates.get_nowait()
+                except queue.Empty:
+                    await asyncio.sleep(POLL_INTERVAL)
+                else:
+                    if data is None:
+                        break
+                    await application.update_queue.put(Update.de_json(data, application.bot))
+                    processed += 1
+
+                if time.monotonic() - last_report >= METRICS_INTERVAL:
+                    metrics.put(shard_metrics(main, index, processed))
+                    last_report = time.monotonic()
+        finally:
+            await application.stop()
+            flusher.cancel()
+            # Запись в потоке не должна пересечься с финальной registry.flush()
+            await asyncio.gather(flusher, return_exceptions=True)
+            main.registry.flush()
+            main.registry.backend.close()
+            metrics.put(shard_metrics(main, index, processed))
+            print(f"⏹️ Воркер {index} остановлен")
+
+
+def shard_metrics(main, index, processed):
+    import metrics
+    return {
+        'shard': index,
+        'pid': os.getpid(),
+        'updates': processed,
+        'pending_updates': main.registry.dirty,
+        'cache': main.registry.cache.stats(),
+        'metrics': metrics.snapshot()
+    }
+
+
+class Supervisor:
+    """Запускает воркеры, распределяет обновления и перезапускает упавшие процессы"""
+
+    def __init__(self, shards, token, stub=False):
+        self.shards = shards
+        self.token = token
+        self.stub = stub
+        self.restarts = [0] * shards
+        self.shard_stats = {}
+        self._context = multiprocessing.get_context('spawn')
+        self._queues = [self._context.Queue() for _ in range(shards)]
+        self._metrics = self._context.Queue()
+        self._processes = [None] * shards
+        # Обновления для перезапускаемых воркеров, пока переносится их старая очередь
+        self._held = {}
+        self._stopping = False
+
+    def _spawn(self, index):
+        process = self._context.Process(
+            target=run_worker,
+            args=(index, self.shards, self._queues[index], self._metrics, self.token, self.stub),
+            name=f"shard-{index}",
+            daemon=False
+        )
+        process.start()
+        self._processes[index] = process
+
+    def start(self):
+        for index in range(self.shards):
+            self._spawn(index)
+
+    def route(self, update_data, chat_id):
+        index = shard_for(chat_id, self.shards)
+        if index in self._held:
+            self._held[index].append(update_data)
+        else:
+            self._queues[index].put(update_data)
+
+    async def route_update(self, update, context):
+        chat = update.effective_chat
+        self.route(update.to_dict(), chat.id if chat else None)
+
+    def collect_metrics(self):
+        while True:
+            try:
+                stats = self._metrics.get_nowait()
+            except queue.Empty:
+                return
+            self.shard_stats[stats['shard']] = stats
+
+    def aggregate(self):
+        """Сумма метрик по всем воркерам"""
+        self.collect_metrics()
+        total = {'workers': self.shards, 'alive': 0, 'restarts': sum(self.restarts),
+                 'updates': 0, 'queued': 0, 'cache': {}}
+        for index, process in enumerate(self._processes):
+            if process is not None and process.is_alive():
+                total['alive'] += 1
+            try:
+                total['queued'] += self._queues[index].qsize()
+            except NotImplementedError:
+                pass
+        for stats in self.shard_stats.values():
+            total['updates'] += stats['updates']
+            for key, value in stats['cache'].items():
+                total['cache'][key] = total['cache'].get(key, 0) + value
+        return total
+
+    def render_metrics(self):
+        """Метрики всех воркеров в формате Prometheus"""
+        import metrics
+        self.collect_metrics()
+        combined = metrics.merge_snapshots([stats['metrics'] for stats in self.shard_stats.values()])
+        restarts = metrics.Counter('bot_worker_restarts_total', 'Перезапуски воркеров', ('shard',))
+        for index, count in enumerate(self.restarts):
+            restarts.inc(index, amount=count)
+        updates = metrics.Counter('bot_worker_updates_total', 'Обновления, переданные воркеру', ('shard',))
+        for stats in self.shard_stats.values():
+            updates.inc(stats['shard'], amount=stats['updates'])
+        return metrics.render(combined + [restarts, updates])
+
+    async def monitor(self):
+        """Перезапускает упавшие воркеры и раз в STATUS_INTERVAL секунд печатает сводку"""
+        last_status = time.monotonic()
+        while not self._stopping:
+            await asyncio.sleep(RESTART_DELAY)
+            self.collect_metrics()
+            if STATUS_INTERVAL and time.monotonic() - last_status >= STATUS_INTERVAL:
+                print(f"📊 Воркеры: {self.aggregate()}")
+                last_status = time.monotonic()
+            for index, process in enumerate(self._processes):
+                if self._stopping or process.is_alive():
+                    continue
+                self.restarts[index] += 1
+                print(f"❌ Воркер {index} завершился с кодом {process.exitcode}, перезапускаем")
+                await self._replace_queue(index)
+                self._spawn(index)
+
+    async def _replace_queue(self, index):
+        """Переносит необработанные обновления упавшего воркера в новую очередь.
+
+        Очередь заменяется, потому что упавший процесс мог унести с собой ее
+        блокировку. Новые обновления на это время откладываются, чтобы порядок
+        сохранился.
+        """
+        old = self._queues[index]
+        new = self._queues[index] = self._context.Queue()
+        self._held[index] = []
+        try:
+            moved = await asyncio.to_thread(self._drain, old, new)
+        finally:
+            for update_data in self._held.pop(index):
+                new.put(update_data)
+        if moved:
+            print(f"↪️ Воркер {index}: перенесено необработанных обновлений: {moved}")
+
+    @staticmethod
+    def _drain(old, new):
+        moved = 0
+        while True:
+            try:
+                update_data = old.get(True, DRAIN_TIMEOUT)
+            except queue.Empty:
+                break
+            if update_data is not None:
+                new.put(update_data)
+                moved += 1
+        old.close()
+        # Если блокировка потеряна, остаток старой очереди не должен держать выход супервизора
+        old.cancel_join_thread()
+        return moved
+
+    def stop(self, timeout=30.0):
+        self._stopping = True
+        for updates in self._queues:
+            updates.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            if process is None:
+                continue
+            process.join(max(0.0, deadline - time.monotonic()))
+            if process.is_alive():
+                process.terminate()
+        print(f"📊 Итог по воркерам: {self.aggregate()}")
+
+
+def build_ingress(supervisor, token, stub=False, metrics_address=None):
+    import metrics
+    from telegram import Update
+    from telegram.ext import Application, TypeHandler
+
+    async def post_init(application):
+        application.bot_data['monitor'] = asyncio.create_task(supervisor.monitor())
+        if metrics_address:
+            host, port = metrics_address
+            application.bot_data['metrics_server'] = await metrics.start_metrics_server(
+                host, int(port), supervisor.render_metrics
+            )
+            print(f"📈 Метрики воркеров: http://{host}:{port}/metrics")
+
+    async def post_shutdown(application):
+        task = application.bot_data.pop('monitor', None)
+        if task:
+            task.cancel()
+        metrics_server = application.bot_data.pop('metrics_server', None)
+        if metrics_server:
+            metrics_server.close()
+        await asyncio.to_thread(supervisor.stop)
+
+    builder = Application.builder().token(token).post_init(post_init).post_shutdown(post_shutdown)
+    if stub:
+        from stub_api import StubRequest
+        builder = builder.request(StubRequest()).get_updates_request(StubRequest())
+    application = builder.build()
+    application.add_handler(TypeHandler(Update, supervisor.route_update))
+    return application
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Запуск бота в несколько процессов")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--stub', action='store_true',
+                        help="заглушка вместо Bot API (для локальной проверки)")
+    args = parser.parse_args()
+
+    import main as bot
+    token = STUB_TOKEN if args.stub else os.getenv('BOT_TOKEN')
+
+    supervisor = Supervisor(args.workers, token, args.stub)
+    supervisor.start()
+    metrics_address = (bot.METRICS_HOST, bot.METRICS_PORT) if bot.METRICS_PORT else None
+    application = build_ingress(supervisor, token, args.stub, metrics_address)
+
+    print(f"🟢 Супервизор запущен: {args.workers} воркеров")
+    if bot.BOT_MODE == 'webhook':
+        bot.run_webhook(application)
+    else:
+        from telegram import Update
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+
+
+if __name__ == '__main__':
+    main()
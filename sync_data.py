@@ -1,44 +1,141 @@
 # sync_data.py
+import asyncio
 import os
 import subprocess
-import json
-import sys
+import time
 from datetime import datetime
 
-def sync_with_github():
+from metrics import SYNC_DURATION
+
+
+class SyncService:
+    """Синхронизация members.json с GitHub без блокировки цикла событий.
+
+    git запускается через asyncio-подпроцессы, одновременно выполняется не
+    больше одной git-операции. Изменения накапливаются: после notify_changed()
+    коммит и push выполняются не раньше чем через debounce секунд.
+    """
+
+    def __init__(self, cwd=None, data_file="members.json", debounce=60.0):
+        self.cwd = cwd or os.getcwd()
+        self.data_file = data_file
+        self.debounce = debounce
+        self.state = "idle"
+        self.last_sync = None
+        self.last_latency = None
+        self.last_error = None
+        self._lock = asyncio.Lock()
+        self._changed = asyncio.Event()
+
+    async def _git(self, *args, check=True):
+        process = await asyncio.create_subprocess_exec(
+            "git", *args, cwd=self.cwd,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        stdout, stderr = stdout.decode(errors="replace"), stderr.decode(errors="replace")
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, ["git", *args], stdout, stderr)
+        return stdout
+
+    async def _run(self, state, operation):
+        async with self._lock:
+            self.state = state
+            started = time.monotonic()
+            try:
+                result = await operation()
+            except Exception as e:
+                self.last_error = f"{e}: {getattr(e, 'stderr', '') or ''}".strip()
+                raise
+            else:
+                self.last_error = None
+                self.last_sync = datetime.now()
+                return result
+            finally:
+                self.last_latency = time.monotonic() - started
+                SYNC_DURATION.observe(self.last_latency, state)
+                self.state = "idle"
+
+    async def _pull(self):
+        head_before = await self._git("rev-parse", "HEAD", check=False)
+        # Незакоммиченная копия data_file помешала бы pull. Данные бота хранятся
+        # в памяти и после pull записываются заново, поэтому файл просто
+        # возвращаем к версии из HEAD
+        await self._git("checkout", "HEAD", "--", self.data_file, check=False)
+        await self._git("pull")
+        head_after = await self._git("rev-parse", "HEAD", check=False)
+        return head_before != head_after
+
+    async def _push_changes(self):
+        status = await self._git("status", "--porcelain", "--", self.data_file)
+        if not status.strip():
+            return False
+
+        await self._git("add", self.data_file)
+        commit_message = f"Auto-sync: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        await self._git("commit", "-m", commit_message)
+        await self._git("push")
+        return True
+
+    async def _sync(self):
+        pushed = await self._push_changes()
+        pulled = await self._pull()
+        return pushed, pulled
+
+    async def pull(self):
+        """git pull. Возвращает True, если пришли новые коммиты.
+
+        Незакоммиченные изменения data_file отбрасываются: вызывающий должен
+        держать их в памяти и не писать файл, пока идет pull.
+        """
+        return await self._run("pull", self._pull)
+
+    async def push_changes(self):
+        """Коммитит и пушит data_file. Возвращает False, если изменений нет"""
+        return await self._run("push", self._push_changes)
+
+    async def sync(self):
+        """Отправляет локальные изменения и забирает обновления: (pushed, pulled)"""
+        return await self._run("sync", self._sync)
+
+    def notify_changed(self):
+        self._changed.set()
+
+    async def run(self):
+        """Фоновая задача: пачками отправляет изменения после notify_changed()"""
+        while True:
+            await self._changed.wait()
+            await asyncio.sleep(self.debounce)
+            self._changed.clear()
+            try:
+                if await self.push_changes():
+                    print(f"[{datetime.now()}] Данные успешно отправлены на GitHub")
+            except Exception as e:
+                print(f"Ошибка синхронизации: {self.last_error or e}")
+
+    def status(self):
+        return {
+            "state": self.state,
+            "last_sync": self.last_sync,
+            "last_latency": self.last_latency,
+            "last_error": self.last_error,
+            "pending": self._changed.is_set()
+        }
+
+
+async def sync_with_github(cwd=None):
     """Синхронизирует данные с GitHub"""
+    service = SyncService(cwd)
     try:
-        # Путь к файлу с данными
-        data_file = "members.json"
-        
-        # Проверяем, есть ли изменения
-        result = subprocess.run(["git", "status", "--porcelain"], 
-                              capture_output=True, text=True, cwd=os.getcwd())
-        
-        if data_file in result.stdout:
-            print(f"[{datetime.now()}] Обнаружены изменения в {data_file}, синхронизируем...")
-            
-            # Добавляем файл
-            subprocess.run(["git", "add", data_file], check=True, cwd=os.getcwd())
-            
-            # Коммитим
-            commit_message = f"Auto-sync: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
-            subprocess.run(["git", "commit", "-m", commit_message], 
-                         check=True, cwd=os.getcwd())
-            
-            # Пушим
-            subprocess.run(["git", "push"], check=True, cwd=os.getcwd())
+        print(f"[{datetime.now()}] Синхронизируем данные с GitHub...")
+        pushed, pulled = await service.sync()
+        if pushed:
             print(f"[{datetime.now()}] Данные успешно отправлены на GitHub")
-        
-        # Pull обновлений
-        print(f"[{datetime.now()}] Проверяем обновления с GitHub...")
-        subprocess.run(["git", "pull"], check=True, cwd=os.getcwd())
-        print(f"[{datetime.now()}] Синхронизация завершена")
-        
+        print(f"[{datetime.now()}] Синхронизация завершена за {service.last_latency:.2f} с")
     except subprocess.CalledProcessError as e:
-        print(f"Ошибка синхронизации: {e}")
+        print(f"Ошибка синхронизации: {e}\n{e.stderr}")
     except Exception as e:
         print(f"Неожиданная ошибка: {e}")
 
 if __name__ == "__main__":
-    sync_with_github()
\ No newline at end of file
+    asyncio.run(sync_with_github())
\ No newline at end of file